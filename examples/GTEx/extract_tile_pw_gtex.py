@@ -1,55 +1,340 @@
 import argparse
+import asyncio
+import hashlib
 import os
+import tarfile
+import tempfile
 import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 from pathlib import Path
-from random import randint
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
+import aiofiles
+import httpx
+import numpy as np
 import pandas as pd
-import requests
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from sklearn.model_selection import train_test_split
 from tqdm import tqdm
 
-from histolab.slide import SlideSet
+from histolab.slide import Slide
 from histolab.tiler import RandomTiler
 
 URL_ROOT = "https://brd.nci.nih.gov/brd/imagedownload"
+MAX_WORKERS = 8
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 
-def download_wsi_gtex(dataset_dir: str, sample_ids: List[str]) -> None:
-    """Download into ``dataset_dir`` all the GTEx WSIs corresponding to ``sample_ids``
+class TokenBucket:
+    """Token bucket limiting the rate of the requests to the server.
+
+    Arguments
+    ---------
+    rate : float
+        Number of requests per second allowed on average. If not positive, requests
+        are not limited.
+    capacity : int, optional
+        Maximum number of requests allowed in a burst. Default is 1.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until a request is allowed."""
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last) * self.rate
+            )
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._tokens = 1
+                now = time.monotonic()
+            self._last = now
+            self._tokens -= 1
+
+
+def _retry_delay(response: httpx.Response, attempt: int) -> float:
+    """Return the seconds to wait before retrying the request of ``response``
+
+    The ``Retry-After`` header is honored when expressed in seconds, otherwise an
+    exponential backoff is used.
+
+    Parameters
+    ----------
+    response : httpx.Response
+        Response to retry
+    attempt : int
+        Number of the attempts already performed
+
+    Returns
+    -------
+    float
+        Seconds to wait
+    """
+    retry_after = response.headers.get("Retry-After", "")
+    return float(retry_after) if retry_after.isdigit() else float(2**attempt)
+
+
+async def _stream_to_file(
+    client: httpx.AsyncClient, bucket: TokenBucket, url: str, path: str
+) -> str:
+    """Stream the resource at ``url`` into ``path`` and return its SHA256 hash
+
+    Parameters
+    ----------
+    client : httpx.AsyncClient
+        Client whose HTTP/2 connections are shared across downloads
+    bucket : TokenBucket
+        Rate limiter shared among the downloads
+    url : str
+        URL of the resource
+    path : str
+        Path where to save the resource
+
+    Returns
+    -------
+    str
+        SHA256 hash of the resource
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        await bucket.acquire()
+        async with client.stream("GET", url) as response:
+            if response.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                await asyncio.sleep(_retry_delay(response, attempt))
+                continue
+            response.raise_for_status()
+            sha256 = hashlib.sha256()
+            async with aiofiles.open(path, "wb") as output_file:
+                async for chunk in response.aiter_bytes(1 << 20):
+                    await output_file.write(chunk)
+                    sha256.update(chunk)
+            return sha256.hexdigest()
+
+
+async def _download_one(
+    client: httpx.AsyncClient,
+    bucket: TokenBucket,
+    semaphore: asyncio.Semaphore,
+    url: str,
+    target: str,
+    expected_hash: Optional[str] = None,
+) -> str:
+    """Download the GTEx WSI at ``url`` into ``target``
+
+    If ``expected_hash`` is provided, the SHA256 hash of the WSI is computed while
+    streaming and the download is retried once if it does not match.
+
+    Parameters
+    ----------
+    client : httpx.AsyncClient
+        Client whose HTTP/2 connections are shared across downloads
+    bucket : TokenBucket
+        Rate limiter shared among the downloads
+    semaphore : asyncio.Semaphore
+        Semaphore bounding the number of concurrent downloads
+    url : str
+        URL of the GTEx WSI
+    target : str
+        Path where to save the WSI
+    expected_hash : str, optional
+        SHA256 hash the downloaded WSI must have. Default is None, meaning that the
+        WSI is not verified.
+
+    Returns
+    -------
+    str
+        Path of the downloaded WSI
+
+    Raises
+    ------
+    ValueError
+        If the hash of the downloaded WSI does not match ``expected_hash``
+    """
+    async with semaphore:
+        for _ in range(2):
+            # write to a temporary file so that interrupted downloads are not
+            # mistaken for complete WSIs on the next run
+            sha256 = await _stream_to_file(client, bucket, url, f"{target}.part")
+            if expected_hash is None or sha256 == expected_hash:
+                os.replace(f"{target}.part", target)
+                return target
+            os.unlink(f"{target}.part")
+    raise ValueError(
+        f"SHA256 hash of {target} does not match the expected one ({expected_hash})"
+    )
+
+
+async def download_wsi_gtex(
+    dataset_dir: str,
+    downloads: List[Tuple[str, str]],
+    known_hashes: Optional[Dict[str, str]] = None,
+    requests_per_second: float = 0.1,
+) -> List[str]:
+    """Download into ``dataset_dir`` all the GTEx WSIs listed in ``downloads``
+
+    Downloads are multiplexed over HTTP/2 connections shared by a single client.
 
     Parameters
     ----------
     dataset_dir : str
         Path where to save the WSIs
-    sample_ids : List[str]
-        List of GTEx WSI ids
+    downloads : List[Tuple[str, str]]
+        List of (url, target path) pairs of the GTEx WSIs. Target paths must be
+        located in ``dataset_dir``
+    known_hashes : Dict[str, str], optional
+        SHA256 hashes of the WSIs, keyed by target path, used to verify the
+        downloads. WSIs without a known hash are not verified. Default is None.
+    requests_per_second : float, optional
+        Maximum rate of the requests to the GTEx server, shared by all the
+        downloads. If not positive, requests are not limited. Default is 0.1.
+
+    Returns
+    -------
+    List[str]
+        Paths of the WSIs listed in ``downloads`` available in ``dataset_dir``
     """
-    dir_files = os.listdir(dataset_dir)
-    sample_ids = set(sample_ids)  # avoid any possible repetition
-    downloaded = set(filter(lambda sid: f"{sid}.svs" in dir_files, sample_ids))
-    to_download = set(sample_ids).difference(downloaded)
+    known_hashes = known_hashes if known_hashes is not None else {}
+    with os.scandir(dataset_dir) as entries:
+        existing = {entry.path for entry in entries}
+    downloads = dict(downloads)  # avoid any possible repetition
+    downloaded = {url for url, target in downloads.items() if target in existing}
+    to_download = {
+        url: target for url, target in downloads.items() if url not in downloaded
+    }
 
     if len(to_download) > 0:
         if len(downloaded) > 0:
-            print(f"{len(downloaded)} out of {len(sample_ids)} found. Resuming:")
+            print(f"{len(downloaded)} out of {len(downloads)} found. Resuming:")
         else:
             print(
                 "downloading GTEx WSI dataset. "
                 "This may take several minutes to complete."
             )
-        for sample_id in tqdm(
-            to_download, initial=len(downloaded), total=len(sample_ids)
-        ):
-            with requests.get(f"{URL_ROOT}/{sample_id}", stream=True) as request:
-                request.raise_for_status()
-                with open(
-                    os.path.join(dataset_dir, f"{sample_id}.svs"), "wb"
-                ) as output_file:
-                    for chunk in request.iter_content(chunk_size=8192):
-                        output_file.write(chunk)
-            time.sleep(randint(3, 7))  # slight delay to avoid over-flooding
+        bucket = TokenBucket(requests_per_second)
+        semaphore = asyncio.Semaphore(MAX_WORKERS)
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+            retries=MAX_RETRIES,
+        )
+        async with httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(300.0, connect=10.0),
+            follow_redirects=True,
+        ) as client:
+            coroutines = [
+                _download_one(
+                    client,
+                    bucket,
+                    semaphore,
+                    url,
+                    target,
+                    known_hashes.get(target),
+                )
+                for url, target in to_download.items()
+            ]
+            for download in tqdm(
+                asyncio.as_completed(coroutines),
+                initial=len(downloaded),
+                total=len(downloads),
+            ):
+                existing.add(await download)
+
+    return list(downloads.values())
+
+
+@lru_cache(maxsize=None)
+def _list_svs(dataset_dir: str) -> Tuple[str, ...]:
+    """Return the paths of the SVS files in ``dataset_dir``
+
+    The directory is scanned only once, subsequent calls reuse the cached result.
+
+    Parameters
+    ----------
+    dataset_dir : str
+        Path were the WSIs are saved
+
+    Returns
+    -------
+    Tuple[str, ...]
+        Paths of the SVS files
+    """
+    with os.scandir(dataset_dir) as entries:
+        return tuple(
+            sorted(entry.path for entry in entries if entry.name.endswith(".svs"))
+        )
+
+
+_random_tiles_extractor: Optional[RandomTiler] = None
+
+
+def _init_worker(
+    tile_size: Tuple[int, int], n_tiles: int, level: int, check_tissue: bool
+) -> None:
+    """Build the RandomTiler reused by a worker process for all its slides
+
+    Parameters
+    ----------
+    tile_size : Tuple[int, int]
+        width and height of the cropped tiles
+    n_tiles : int
+        Maximum number of tiles to extract
+    level : int
+        Magnification level from which extract the tiles
+    check_tissue : bool
+        Whether to check if the tile has enough tissue to be saved
+    """
+    global _random_tiles_extractor
+    _random_tiles_extractor = RandomTiler(
+        tile_size=tile_size,
+        n_tiles=n_tiles,
+        level=level,
+        check_tissue=check_tissue,
+        prefix="",
+    )
+
+
+def _extract_one(slide_path: str, processed_path: str, seed: int) -> None:
+    """Save random tiles extracted from the WSI at ``slide_path`` into `processed_path`
+
+    Tiles are stored in a single ``{slide name}.tar`` shard rather than as one PNG
+    file each. The Slide is rebuilt from its path so that this function can be run
+    in a worker process, where the RandomTiler built by ``_init_worker`` is reused
+    after updating its prefix and seed.
+
+    Parameters
+    ----------
+    slide_path : str
+        Path of the WSI
+    processed_path : str
+        Path where to store the tiles
+    seed : int
+        Seed for RandomState
+    """
+    with tempfile.TemporaryDirectory(dir=processed_path) as staging_dir:
+        slide = Slide(slide_path, staging_dir)
+        _random_tiles_extractor.prefix = f"{slide.name}_"
+        _random_tiles_extractor.seed = seed
+
+        _random_tiles_extractor.extract(slide)
+
+        shard = os.path.join(processed_path, f"{slide.name}.tar")
+        with tarfile.open(f"{shard}.part", "w") as tar:
+            for tile_filename in sorted(os.listdir(staging_dir)):
+                tar.add(os.path.join(staging_dir, tile_filename), tile_filename)
+        os.replace(f"{shard}.part", shard)
 
 
 def extract_random_tiles(
@@ -60,6 +345,7 @@ def extract_random_tiles(
     level: int,
     seed: int,
     check_tissue: bool,
+    slide_paths: Optional[List[str]] = None,
 ) -> None:
     """Save random tiles extracted from WSIs in `dataset_dir` into `processed_path`
 
@@ -76,24 +362,34 @@ def extract_random_tiles(
     level : int
         Magnification level from which extract the tiles
     seed : int
-        Seed for RandomState
+        Base seed for RandomState, combined with each slide name
     check_tissue : bool
         Whether to check if the tile has enough tissue to be saved
+    slide_paths : List[str], optional
+        Paths of the WSIs to process, e.g. as returned by ``download_wsi_gtex``.
+        Default is None, meaning that all the SVS files in ``dataset_dir`` are
+        processed.
     """
-    slideset = SlideSet(dataset_dir, processed_path, valid_extensions=[".svs"])
-
-    for slide in tqdm(slideset.slides):
-        prefix = f"{slide.name}_"
-        random_tiles_extractor = RandomTiler(
-            tile_size=tile_size,
-            n_tiles=n_tiles,
-            level=level,
-            seed=seed,
-            check_tissue=check_tissue,
-            prefix=prefix,
-        )
-
-        random_tiles_extractor.extract(slide)
+    if slide_paths is None:
+        slide_paths = _list_svs(dataset_dir)
+
+    with ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        initializer=_init_worker,
+        initargs=(tile_size, n_tiles, level, check_tissue),
+    ) as executor:
+        futures = [
+            executor.submit(
+                _extract_one,
+                slide_path,
+                processed_path,
+                # distinct, reproducible RandomState stream for each slide
+                seed ^ zlib.crc32(Path(slide_path).stem.encode()),
+            )
+            for slide_path in slide_paths
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
 
 
 def train_test_df_patient_wise(
@@ -126,17 +422,22 @@ def train_test_df_patient_wise(
         Test dataset
     """
 
-    patient_with_labels = (
-        dataset_df.groupby(patient_col)[label_col].unique().apply(list)
+    # sorted, as previously returned by groupby, to keep the split reproducible
+    unique_patients = np.array(
+        sorted(dataset_df[patient_col].dropna().unique()), dtype=object
     )
-    unique_patients = patient_with_labels.index.values
 
     train_patients, test_patients = train_test_split(
         unique_patients, test_size=test_size, random_state=seed
     )
 
-    dataset_train_df = dataset_df.loc[dataset_df[patient_col].isin(train_patients)]
-    dataset_test_df = dataset_df.loc[dataset_df[patient_col].isin(test_patients)]
+    # assign each row to its partition with a single pass over the patient column
+    assignment = {patient: 0 for patient in train_patients}
+    assignment.update({patient: 1 for patient in test_patients})
+    side = dataset_df[patient_col].map(assignment).to_numpy()
+
+    dataset_train_df = dataset_df[side == 0]
+    dataset_test_df = dataset_df[side == 1]
 
     return dataset_train_df, dataset_test_df
 
@@ -158,7 +459,7 @@ def split_tiles_patient_wise(
     Parameters
     ----------
     tiles_dir : str
-        Tile dataset directory.
+        Tile dataset directory, containing one tar shard of tiles per WSI.
     metadata_df : pd.DataFrame
         CSV of patient metadata.
     train_csv_path : str
@@ -174,18 +475,40 @@ def split_tiles_patient_wise(
     seed : int, optional
         Seed for RandomState, by default 1234
     """
-    tiles_filenames = [
-        f for f in os.listdir(tiles_dir) if os.path.splitext(f)[1] == ".png"
-    ]
+    with os.scandir(tiles_dir) as entries:
+        # DirEntry.is_file() reuses the file type returned by the directory scan
+        shards = [
+            entry.name
+            for entry in entries
+            if entry.name.endswith(".tar") and entry.is_file()
+        ]
+    shards_filenames = []
+    tiles_filenames = []
+    for shard in shards:
+        with tarfile.open(os.path.join(tiles_dir, shard)) as tar:
+            shard_tiles = tar.getnames()
+        shards_filenames.extend([shard] * len(shard_tiles))
+        tiles_filenames.extend(shard_tiles)
     tiles_filenames_df = pd.DataFrame(
         {
-            "tile_filename": tiles_filenames,
-            "Tissue Sample ID": [f.split("_")[0] for f in tiles_filenames],
+            "shard_filename": pd.array(shards_filenames, dtype="string"),
+            "tile_filename": pd.array(tiles_filenames, dtype="string"),
         }
     )
+    tiles_filenames_df["Tissue Sample ID"] = tiles_filenames_df[
+        "shard_filename"
+    ].str.slice(stop=-len(".tar"))
 
-    tiles_metadata = metadata_df.join(
-        tiles_filenames_df.set_index("Tissue Sample ID"), on="Tissue Sample ID"
+    # join on categorical codes rather than on the sample id strings
+    sample_id_dtype = pd.CategoricalDtype(
+        metadata_df["Tissue Sample ID"].dropna().unique()
+    )
+    tiles_metadata = pd.merge(
+        metadata_df.astype({"Tissue Sample ID": sample_id_dtype}),
+        tiles_filenames_df.astype({"Tissue Sample ID": sample_id_dtype}),
+        on="Tissue Sample ID",
+        how="left",
+        sort=False,
     )
 
     train_df, test_df = train_test_df_patient_wise(
@@ -196,8 +519,10 @@ def split_tiles_patient_wise(
         seed,
     )
 
-    train_df.to_csv(train_csv_path, index=False)
-    test_df.to_csv(test_csv_path, index=False)
+    pacsv.write_csv(
+        pa.Table.from_pandas(train_df, preserve_index=False), train_csv_path
+    )
+    pacsv.write_csv(pa.Table.from_pandas(test_df, preserve_index=False), test_csv_path)
 
 
 def main():
@@ -254,6 +579,13 @@ def main():
         help="Whether to check if the tile has enough tissue to be saved. "
         "Default True.",
     )
+    parser.add_argument(
+        "--requests_per_second",
+        type=float,
+        default=0.1,
+        help="Maximum rate of the requests to the GTEx server. A non-positive value "
+        "disables the limit. Default 0.1.",
+    )
     args = parser.parse_args()
 
     metadata_csv = Path(args.metadata_csv)
@@ -264,29 +596,57 @@ def main():
     level = args.level
     seed = args.seed
     check_tissue = args.check_tissue
+    requests_per_second = args.requests_per_second
 
     try:
-        gtex_df = pd.read_csv(metadata_csv)
+        gtex_df = pd.read_csv(
+            metadata_csv,
+            dtype={
+                "Tissue Sample ID": "string[pyarrow]",
+                "Subject ID": "category",
+                "Tissue": "category",
+            },
+            engine="pyarrow",
+        )
     except FileNotFoundError:
         print(f"Metadata CSV filepath {metadata_csv} does not exist. Please check.")
         return
     else:
-        sample_ids = gtex_df["Tissue Sample ID"].tolist()
+        sample_ids = gtex_df["Tissue Sample ID"].drop_duplicates().astype(str)
+        urls = URL_ROOT + "/" + sample_ids
+        targets = str(wsi_dataset_dir) + os.sep + sample_ids + ".svs"
 
     os.makedirs(wsi_dataset_dir, exist_ok=True)
     print("Check GTEX dataset...")
-    download_wsi_gtex(wsi_dataset_dir, sample_ids)
+    slide_paths = asyncio.run(
+        download_wsi_gtex(
+            wsi_dataset_dir,
+            list(zip(urls, targets)),
+            requests_per_second=requests_per_second,
+        )
+    )
     print("done.")
 
+    # directories are created idempotently so that interrupted runs can be resumed
+    tiles_dir = os.path.join(tile_dataset_dir, "tiles")
+    os.makedirs(tiles_dir, exist_ok=True)
+
     print("Extracting Random Tiles...", end=" ")
     extract_random_tiles(
-        wsi_dataset_dir, tile_dataset_dir, tile_size, n_tiles, level, seed, check_tissue
+        wsi_dataset_dir,
+        tiles_dir,
+        tile_size,
+        n_tiles,
+        level,
+        seed,
+        check_tissue,
+        slide_paths=slide_paths,
     )
-    print(f"..saved in {tile_dataset_dir}")
+    print(f"..saved in {tiles_dir}")
 
     print("Split Tiles Patient-wise...", end=" ")
     split_tiles_patient_wise(
-        tiles_dir=os.path.join(tile_dataset_dir, "tiles"),
+        tiles_dir=tiles_dir,
         metadata_df=gtex_df,
         train_csv_path=os.path.join(
             tile_dataset_dir, f"train_tiles_PW_{os.path.basename(metadata_csv)}"
@@ -29,7 +29,7 @@ import PIL
 from requests.exceptions import HTTPError
 
 from .. import __version__
-from ._registry import legacy_registry, registry, registry_urls
+from ._registry import get_hash, legacy_registry, registry, registry_urls
 
 legacy_data_dir = os.path.abspath(os.path.dirname(__file__))
 histolab_distribution_dir = os.path.join(legacy_data_dir, "..")
@@ -166,7 +166,7 @@ def _fetch(data_filename: str) -> str:
         to the internet
     """
     resolved_path = os.path.join(data_dir, "..", data_filename)
-    expected_hash = registry[data_filename]
+    expected_hash = get_hash(data_filename)
 
     # Case 1:
     # The file may already be in the data_dir.
@@ -18,13 +18,16 @@
 
 # flake8: noqa
 
+import sys
+from types import MappingProxyType
+
 # in legacy datasets we need to put our sample data within the data dir
 legacy_datasets = ["cmu_small_region.svs"]
 
 # Registry of datafiles that can be downloaded along with their SHA256 hashes
 # To generate the SHA256 hash, use the command
 # openssl sha256 filename
-registry = {
+_hashes = {
     "histolab/broken.svs": "26828c763a5ff824a68c6a1b1765dbc19afd5d12f1c12d856b8462741f461d37",
     "histolab/kidney.png": "5c6dc1b9ae10a2865302d9c8eda360362ec47732cb3e9766c38ed90cb9f4c371",
     "data/cmu_small_region.svs": "ed92d5a9f2e86df67640d6f92ce3e231419ce127131697fbbce42ad5e002c8a7",
@@ -44,7 +47,7 @@ APERIO_REPO_URL = "http://openslide.cs.cmu.edu/download/openslide-testdata/Aperi
 TCGA_REPO_URL = "https://api.gdc.cancer.gov/data"
 IDR_REPO_URL = "https://idr.openmicroscopy.org/webclient/render_image_download"
 
-registry_urls = {
+_urls = {
     "histolab/broken.svs": "https://raw.githubusercontent.com/histolab/histolab/master/tests/fixtures/svs-images/broken.svs",
     "histolab/kidney.png": "https://user-images.githubusercontent.com/4196091/100275351-132cc880-2f60-11eb-8cc8-7a3bf3723260.png",
     "aperio/JP2K-33003-1.svs": f"{APERIO_REPO_URL}/JP2K-33003-1.svs",
@@ -59,6 +62,43 @@ registry_urls = {
     "9798554/?format=tif": f"{IDR_REPO_URL}/9798554/?format=tif",
 }
 
-legacy_registry = {
-    ("data/" + filename): registry["data/" + filename] for filename in legacy_datasets
-}
+# read-only views, so that the registries can be shared without defensive copies
+registry = MappingProxyType(_hashes)
+registry_urls = MappingProxyType(_urls)
+
+_legacy_items = tuple(
+    ("data/" + filename, registry["data/" + filename]) for filename in legacy_datasets
+)
+legacy_registry = MappingProxyType(dict(_legacy_items))
+
+
+def get_hash(key: str) -> str:
+    """Return the SHA256 hash of the datafile ``key``.
+
+    Parameters
+    ----------
+    key : str
+        Name of the datafile in the registry, e.g. 'histolab/kidney.png'
+
+    Returns
+    -------
+    str
+        Interned SHA256 hash of the datafile
+    """
+    return sys.intern(registry[key])
+
+
+def get_url(key: str) -> str:
+    """Return the URL of the datafile ``key``.
+
+    Parameters
+    ----------
+    key : str
+        Name of the datafile in the registry, e.g. 'histolab/kidney.png'
+
+    Returns
+    -------
+    str
+        Interned URL of the datafile
+    """
+    return sys.intern(registry_urls[key])
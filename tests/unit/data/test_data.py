@@ -36,7 +36,6 @@ from histolab.data import (
     _registry,
     cmu_small_region,
     data_dir,
-    registry,
 )
 
 from ...fixtures import SVS
@@ -73,7 +72,7 @@ def test_cmu_small_region():
     assert cmu_small_region_image.dimensions == (2220, 2967)
 
 
-@patch.dict(registry, {"data/cmu_small_region_broken.svs": "bar"}, clear=True)
+@patch.dict(_registry._hashes, {"data/cmu_small_region_broken.svs": "bar"}, clear=True)
 @patch.object(_registry, "legacy_datasets", ["data/cmu_small_region_broken.svs"])
 def test_file_url_not_found():
     data_filename = "data/cmu_small_region_broken.svs"
@@ -111,7 +110,21 @@ def it_knows_its_hash(request, file, hash, expected_value):
     assert has_hash is expected_value
 
 
-@patch.dict(registry, {"data/cmu_small_region.svs": "bar"}, clear=True)
+@patch.dict(_registry._hashes, {"histolab/kidney.png": "1234abcd"}, clear=True)
+@patch.dict(_registry._urls, {"histolab/kidney.png": "https://kidney"}, clear=True)
+def it_knows_datafile_hash_and_url():
+    assert _registry.get_hash("histolab/kidney.png") == "1234abcd"
+    assert _registry.get_url("histolab/kidney.png") == "https://kidney"
+
+
+def it_provides_read_only_registries():
+    with pytest.raises(TypeError):
+        _registry.registry["histolab/kidney.png"] = "1234abcd"
+    with pytest.raises(TypeError):
+        _registry.registry_urls["histolab/kidney.png"] = "https://kidney"
+
+
+@patch.dict(_registry._hashes, {"data/cmu_small_region.svs": "bar"}, clear=True)
 @patch("histolab.data.image_fetcher", None)
 def it_raises_error_on_fetch_if_image_fetcher_is_None():
     with pytest.raises(ModuleNotFoundError) as err: